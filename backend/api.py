@@ -1,11 +1,20 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import sqlite3
 import os
+import io
+import csv
 import random
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+import sharding
+import approx
+
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
@@ -24,6 +33,191 @@ def get_db():
     conn.row_factory = sqlite3.Row
     return conn
 
+# --- FACT_SALES ACCESS (single table or shards) ---
+def get_sales_db(date_key, city):
+    """
+    Main-DB connection plus the Fact_Sales table to write this date/city's row to. In sharded
+    mode the row's shard is attached, so Sales_Keys and the shard commit in one transaction.
+    """
+    conn = get_db()
+    if sharding.is_sharded():
+        sharding.attach_shard(conn, sharding.shard_key(date_key, city))
+        return conn, "shard.Fact_Sales"
+    return conn, "Fact_Sales"
+
+def sales_dbs(city=None, year=None):
+    """Database files to scan for Fact_Sales, pruned by the city/year filters in sharded mode."""
+    if sharding.is_sharded():
+        return sharding.list_shards(city, year)
+    return [DB_PATH]
+
+def query_sales(sql, params=(), city=None, year=None):
+    """
+    Runs a Fact_Sales query against the main DB, or fans it out over the shards on a
+    thread pool. Returns one row list per database; merge them with merge_partials().
+    """
+    if not sharding.is_sharded():
+        conn = get_db()
+        try:
+            return [conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+    return sharding.fanout(sql, params, sales_dbs(city, year))
+
+def merge_partials(partials, key_cols=1):
+    """
+    Merges partial aggregates of shape (key..., value1, value2, ...) by summing the values
+    of equal keys. Works for SUM and COUNT (and AVG via SUM + COUNT). Returns {key: [values]},
+    with tuple keys when key_cols > 1.
+    """
+    merged = {}
+    for rows in partials:
+        for row in rows:
+            key = row[0] if key_cols == 1 else tuple(row[:key_cols])
+            vals = list(row[key_cols:])
+            if key in merged:
+                merged[key] = [a + (b or 0) for a, b in zip(merged[key], vals)]
+            else:
+                merged[key] = [v or 0 for v in vals]
+    return merged
+
+def sort_labels(keys, reverse=False):
+    # SQLite puts NULL first when sorting ascending; mimic that for merged group keys
+    return sorted(keys, key=lambda k: (k is not None, k or ''), reverse=reverse)
+
+def top_k(merged, k, col=0):
+    return sorted(merged.items(), key=lambda kv: kv[1][col], reverse=True)[:k]
+
+# --- IDEMPOTENT INGEST ---
+# (transaction_id, product_key) pairs recently confirmed to be in the DB. Retries hit this
+# LRU and skip the DB; anything else goes straight to INSERT ... ON CONFLICT DO NOTHING
+# against the (transaction_id, product_key) unique index.
+RECENT_KEYS_MAX = 100_000
+recent_keys = OrderedDict()
+recent_keys_lock = threading.Lock()
+ingest_stats = {"inserted": 0, "duplicates": 0, "duplicates_cached": 0}
+
+# Sketches behind ?approx=true (the stratified sample itself lives in SQLite)
+sketch_store = approx.SketchStore()
+
+def ensure_sales_unique_index(conn):
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_sales_txn_product'").fetchone()
+        if not exists:
+            # Pre-existing duplicates would make the unique index fail: keep the first copy of each
+            removed = conn.execute("""
+                DELETE FROM Fact_Sales WHERE rowid NOT IN (
+                    SELECT MIN(rowid) FROM Fact_Sales GROUP BY transaction_id, product_key
+                )
+            """).rowcount
+            if removed:
+                print(f"⚠️ Removed {removed} duplicate Fact_Sales rows before creating the unique index")
+        conn.execute(sharding.FACT_SALES_INDEX)
+        conn.commit()
+    except sqlite3.Error as e:
+        # Missing table (ETL not run yet) - ingest fails until the ETL has built Fact_Sales
+        print(f"⚠️ Could not create Fact_Sales unique index: {e}")
+
+def is_recent_key(key):
+    """True if the key was recently inserted (or found already present) by this process."""
+    with recent_keys_lock:
+        if key in recent_keys:
+            recent_keys.move_to_end(key)
+            return True
+        return False
+
+def remember_key(key):
+    """Caches a key once the DB has it: only after a commit or a reported conflict."""
+    with recent_keys_lock:
+        recent_keys[key] = None
+        recent_keys.move_to_end(key)
+        if len(recent_keys) > RECENT_KEYS_MAX:
+            recent_keys.popitem(last=False)
+
+def insert_sale(values):
+    """
+    Idempotent insert of one Fact_Sales row. `values` follows the column order
+    (transaction_id, date_key, product_key, quantity, total_amount, city, source_system, customer_name, season).
+    Returns True if the row was inserted, False if it was a duplicate.
+    """
+    key = (values[0], values[2])
+    if is_recent_key(key):
+        with recent_keys_lock:
+            ingest_stats["duplicates"] += 1
+            ingest_stats["duplicates_cached"] += 1
+        return False
+
+    # Only opened once the cache says this may be a new row
+    conn, table = get_sales_db(values[1], values[5])
+    try:
+        # In sharded mode the row's shard depends on date/city, so a retry can land in a
+        # different shard - the key is claimed globally, atomically with the shard insert
+        if sharding.is_sharded() and not conn.execute(
+                "INSERT INTO main.Sales_Keys VALUES (?, ?) ON CONFLICT DO NOTHING", key).rowcount:
+            conn.rollback()
+            remember_key(key)
+            with recent_keys_lock:
+                ingest_stats["duplicates"] += 1
+            return False
+
+        cur = conn.execute(f"""
+            INSERT INTO {table} (
+                transaction_id, date_key, product_key, quantity, total_amount,
+                city, source_system, customer_name, season
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
+        """, values)
+        conn.commit()
+    finally:
+        # Closing without a commit rolls back the claim and the insert together
+        conn.close()
+
+    # Concurrent attempts at the same key all reach the DB; ON CONFLICT picks the winner
+    remember_key(key)
+    with recent_keys_lock:
+        if cur.rowcount:
+            ingest_stats["inserted"] += 1
+        else:
+            ingest_stats["duplicates"] += 1
+
+    if cur.rowcount:
+        observe_for_approx(values)
+    return cur.rowcount > 0
+
+def observe_for_approx(values):
+    """Keeps the approximate-query sample and sketches in step with a newly inserted sale."""
+    conn = get_db()
+    try:
+        pending_id = approx.observe_sale(conn, values[1], values[2], values[4], values[5], values[7])
+        sketch_store.observe(conn, pending_id)
+    except sqlite3.Error as e:
+        # The exact path is unaffected; approx answers just miss this row
+        print(f"⚠️ Could not update approximate-query sample: {e}")
+    finally:
+        conn.close()
+
+@app.on_event("startup")
+def startup_ensure_indexes():
+    conn = get_db()
+    try:
+        ensure_sales_unique_index(conn)
+        if sharding.is_sharded():
+            conn.execute(sharding.SALES_KEYS_DDL)
+            conn.commit()
+        approx.init_approx_tables(conn)
+    finally:
+        conn.close()
+
+@app.on_event("shutdown")
+def shutdown_flush_sketches():
+    conn = get_db()
+    try:
+        sketch_store.flush(conn)
+    finally:
+        conn.close()
+
 # --- UPDATED DATA MODEL ---
 class Order(BaseModel):
     transaction_id: str
@@ -39,14 +233,7 @@ class Order(BaseModel):
 @app.post("/ingest/order", dependencies=[Depends(verify_key)])
 def ingest_realtime_order(order: Order):
     try:
-        conn = get_db()
-        conn.execute("""
-            INSERT INTO Fact_Sales (
-                transaction_id, date_key, product_key, quantity, total_amount, 
-                city, source_system, customer_name, season
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        inserted = insert_sale((
             order.transaction_id, 
             datetime.now().strftime("%Y-%m-%d"), 
             order.product_id, 
@@ -57,44 +244,61 @@ def ingest_realtime_order(order: Order):
             order.customer_name,
             order.season
         ))
-        conn.commit()
-        return {"status": "success"}
+        return {"status": "success" if inserted else "duplicate"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/ingest/stats")
+def get_ingest_stats():
+    with recent_keys_lock:
+        return dict(ingest_stats, cached_keys=len(recent_keys))
+
 # --- 2. DEMO SIMULATION ---
 @app.post("/simulate/new-sale")
 def simulate_sale():
-    conn = get_db()
     seasons = ['Winter', 'Spring', 'Summer', 'Fall']
     # Added random city selection so filters work better
     cities = ['New York', 'London', 'Mumbai', 'Demo City'] 
-    conn.execute("""
-        INSERT INTO Fact_Sales (
-            transaction_id, date_key, product_key, quantity, total_amount, 
-            source_system, season, customer_name, city
-        )
-        VALUES (?, date('now'), 'Simulated Product', 1, ?, 'SIMULATOR', ?, 'Demo User', ?)
-    """, (
-        str(random.randint(1000,9999)), 
+    insert_sale((
+        f"SIM-{uuid.uuid4().hex[:12]}",
+        datetime.now().strftime("%Y-%m-%d"),
+        'Simulated Product',
+        1,
         random.uniform(20, 100), 
-        random.choice(seasons),
-        random.choice(cities)
+        random.choice(cities),
+        'SIMULATOR',
+        'Demo User',
+        random.choice(seasons)
     ))
-    conn.commit()
     return {"msg": "Sale Simulated"}
 
 
 # --- 4. ANALYTICS TABS (EXISTING) ---
 
 @app.get("/analytics/commercial")
-def get_commercial_data():
-    conn = get_db()
-    rev = conn.execute("SELECT strftime('%Y-%m', date_key) as month, SUM(total_amount) as revenue FROM Fact_Sales GROUP BY month ORDER BY month DESC LIMIT 12").fetchall()
-    prod = conn.execute("SELECT product_key, COUNT(*) as units FROM Fact_Sales GROUP BY product_key ORDER BY units DESC LIMIT 5").fetchall()
+def get_commercial_data(approx_mode: bool = Query(False, alias="approx")):
+    if approx_mode:
+        conn = get_db()
+        try:
+            products, _ = sketch_store.snapshot(conn)
+            rev = approx.estimate_strata(conn, "month")
+            cms_error = round(products.error_bound())
+            return {
+                "monthly_revenue": [{"month": m, "revenue": rev[m]["amount"], "error": approx.bound(rev[m]["amount_var"])}
+                                    for m in sort_labels(rev, reverse=True)[:12]],
+                # Count-Min only overcounts: true value lies in [sold - error, sold]
+                "top_products": [{"name": p, "sold": n, "error": cms_error} for p, n in products.top_k(5)],
+                "approx": True
+            }
+        finally:
+            conn.close()
+
+    # Partial aggregates per database; ORDER BY / LIMIT are applied after the merge
+    rev = merge_partials(query_sales("SELECT strftime('%Y-%m', date_key) as month, SUM(total_amount) as revenue FROM Fact_Sales GROUP BY month"))
+    prod = merge_partials(query_sales("SELECT product_key, COUNT(*) as units FROM Fact_Sales GROUP BY product_key"))
     return {
-        "monthly_revenue": [{"month": r['month'], "revenue": r['revenue']} for r in rev],
-        "top_products": [{"name": r['product_key'], "sold": r['units']} for r in prod]
+        "monthly_revenue": [{"month": m, "revenue": rev[m][0]} for m in sort_labels(rev, reverse=True)[:12]],
+        "top_products": [{"name": p, "sold": v[0]} for p, v in top_k(prod, 5)]
     }
 
 @app.get("/analytics/operations")
@@ -120,15 +324,15 @@ def get_operations_data():
         'Shaving Cream': 'Personal Care', 'Hand Sanitizer': 'Personal Care',
     }
 
-    # Fetch all sales with product + season
-    rows = conn.execute("SELECT product_key, season FROM Fact_Sales WHERE season IS NOT NULL").fetchall()
+    # Sales counts per product + season (grouped in SQL, merged across shards)
+    rows = merge_partials(query_sales("SELECT product_key, season, COUNT(*) FROM Fact_Sales WHERE season IS NOT NULL GROUP BY product_key, season"), key_cols=2)
 
     # Group by season + category
     from collections import defaultdict
     season_cat = defaultdict(lambda: defaultdict(int))
-    for r in rows:
-        cat = CATEGORY_MAP.get(r['product_key'], 'Other')
-        season_cat[r['season']][cat] += 1
+    for (product, season), (count,) in rows.items():
+        cat = CATEGORY_MAP.get(product, 'Other')
+        season_cat[season][cat] += count
 
     # Build stacked bar data
     season_order = ['Winter', 'Spring', 'Summer', 'Fall']
@@ -139,24 +343,53 @@ def get_operations_data():
         seasonal_by_category.append(entry)
 
     # Keep existing simple seasonal data for backward compat
-    seasonal = conn.execute("SELECT season, COUNT(*) as sales_count FROM Fact_Sales WHERE season IS NOT NULL GROUP BY season ORDER BY sales_count DESC").fetchall()
+    seasonal = top_k(merge_partials(query_sales("SELECT season, COUNT(*) as sales_count FROM Fact_Sales WHERE season IS NOT NULL GROUP BY season")), 4)
     inv = conn.execute("SELECT AVG(turnover_ratio) as val FROM Fact_Inventory").fetchone()
     delivery = conn.execute("SELECT AVG(delivery_days) as val FROM Fact_Shipments").fetchone()
 
     return {
-        "seasonal_trends": [{"season": r['season'], "sales": r['sales_count']} for r in seasonal],
+        "seasonal_trends": [{"season": season, "sales": v[0]} for season, v in seasonal],
         "seasonal_by_category": seasonal_by_category,
         "inventory_turnover": round(inv['val'] or 0, 2),
         "avg_delivery_days": round(delivery['val'] or 0, 1)
     }
 
 @app.get("/analytics/customer")
-def get_customer_data():
+def get_customer_data(approx_mode: bool = Query(False, alias="approx")):
     conn = get_db()
 
+    if approx_mode:
+        # Distinct customers from the HyperLogLog sketch, CLV trend from the stratified sample
+        try:
+            _, customers = sketch_store.snapshot(conn)
+            clv = approx.estimate_strata(conn, "month")
+            clv.pop(None, None)  # undated rows
+            # Same keys as the exact response; retention and market basket need per-customer /
+            # per-transaction state the sample and sketches don't keep, so they come back as null
+            return {
+                "retention": None,
+                "clv_trend": list(reversed([
+                    {"month": m, "value": round(clv[m]["amount"] / clv[m]["count"], 2), "error": approx.ratio_bound(clv[m])}
+                    for m in sort_labels(clv, reverse=True)[:12] if clv[m]["count"]
+                ])),
+                "market_basket": None,
+                "distinct_customers": {"value": round(customers.estimate()),
+                                       "error": round(customers.error_bound())},
+                "approx": True
+            }
+        finally:
+            conn.close()
+
     # --- Retention: New vs Returning customers ---
-    total_customers = conn.execute("SELECT COUNT(DISTINCT customer_name) FROM Fact_Sales").fetchone()[0] or 1
-    returning = conn.execute("SELECT COUNT(*) FROM (SELECT customer_name FROM Fact_Sales GROUP BY customer_name HAVING COUNT(DISTINCT transaction_id) > 1)").fetchone()[0]
+    if sharding.is_sharded():
+        # A customer can span shards, but a transaction never does (one date, one city),
+        # so per-shard distinct transaction counts add up exactly
+        per_customer = merge_partials(query_sales("SELECT customer_name, COUNT(DISTINCT transaction_id) FROM Fact_Sales WHERE customer_name IS NOT NULL GROUP BY customer_name"))
+        total_customers = len(per_customer) or 1
+        returning = sum(1 for (n,) in per_customer.values() if n > 1)
+    else:
+        total_customers = conn.execute("SELECT COUNT(DISTINCT customer_name) FROM Fact_Sales").fetchone()[0] or 1
+        returning = conn.execute("SELECT COUNT(*) FROM (SELECT customer_name FROM Fact_Sales GROUP BY customer_name HAVING COUNT(DISTINCT transaction_id) > 1)").fetchone()[0]
     new_customers = total_customers - returning
     retention = [
         {"name": "New", "value": new_customers},
@@ -164,28 +397,29 @@ def get_customer_data():
     ]
 
     # --- CLV Trend: average customer lifetime value by month ---
-    clv_rows = conn.execute("""
-        SELECT strftime('%Y-%m', date_key) as month, ROUND(AVG(total_amount), 2) as value
+    clv = merge_partials(query_sales("""
+        SELECT strftime('%Y-%m', date_key) as month, SUM(total_amount), COUNT(total_amount)
         FROM Fact_Sales
         WHERE date_key IS NOT NULL
         GROUP BY month
-        ORDER BY month DESC
-        LIMIT 12
-    """).fetchall()
-    clv_trend = list(reversed([{"month": r["month"], "value": r["value"]} for r in clv_rows]))
+    """))
+    clv_trend = list(reversed([
+        {"month": m, "value": round(clv[m][0] / clv[m][1], 2) if clv[m][1] else None}
+        for m in sort_labels(clv, reverse=True)[:12]
+    ]))
 
     # --- Market Basket: frequently bought together ---
-    basket = conn.execute("""
+    # (self-join stays inside each shard, since a transaction lives in exactly one)
+    basket = merge_partials(query_sales("""
         SELECT A.product_key as item1, B.product_key as item2, COUNT(*) as frequency
         FROM Fact_Sales A
         JOIN Fact_Sales B ON A.transaction_id = B.transaction_id
         WHERE A.product_key < B.product_key
         AND A.product_key NOT LIKE '%Toothpaste%' AND B.product_key NOT LIKE '%Toothpaste%'
         GROUP BY item1, item2
-        ORDER BY frequency DESC LIMIT 5
-    """).fetchall()
-    total_transactions = conn.execute("SELECT COUNT(DISTINCT transaction_id) FROM Fact_Sales").fetchone()[0] or 1
-    market_basket = [{"pair": f"{r['item1']} + {r['item2']}", "count": r['frequency']} for r in basket]
+    """), key_cols=2)
+    total_transactions = sum(r[0] for rows in query_sales("SELECT COUNT(DISTINCT transaction_id) FROM Fact_Sales") for r in rows) or 1
+    market_basket = [{"pair": f"{item1} + {item2}", "count": v[0]} for (item1, item2), v in top_k(basket, 5)]
 
     return {
         "retention": retention,
@@ -194,8 +428,6 @@ def get_customer_data():
     }
 @app.get("/analytics/overview-filtered")
 def get_overview_filtered(period: str, city: str):
-    conn = get_db()
-    
     # 1. Handle Time Filter
     if period == "Last 30 Days":
         date_filter = "date_key >= date('now', '-30 days')"
@@ -216,29 +448,29 @@ def get_overview_filtered(period: str, city: str):
         SELECT {label_fmt} as name, SUM(total_amount) as revenue 
         FROM Fact_Sales 
         WHERE {date_filter} {city_clause}
-        GROUP BY name ORDER BY name ASC
+        GROUP BY name
     """
-    chart_rows = conn.execute(query, params).fetchall()
+    chart = merge_partials(query_sales(query, params, city=city))
 
     # 4. Query for Top Products
     prod_query = f"""
         SELECT product_key as name, COUNT(*) as sales 
         FROM Fact_Sales 
         WHERE {date_filter} {city_clause}
-        GROUP BY name ORDER BY sales DESC LIMIT 5
+        GROUP BY name
     """
-    prod_rows = conn.execute(prod_query, params).fetchall()
+    prods = merge_partials(query_sales(prod_query, params, city=city))
 
     return {
-        "chartData": [{"name": r['name'], "revenue": r['revenue']} for r in chart_rows],
-        "productList": [{"name": r['name'], "sales": r['sales']} for r in prod_rows]
+        "chartData": [{"name": n, "revenue": chart[n][0]} for n in sort_labels(chart)],
+        "productList": [{"name": n, "sales": v[0]} for n, v in top_k(prods, 5)]
     }
 # --- 3. SMART FILTER ENDPOINT ---
-# --- 3. SMART FILTER ENDPOINT ---
-@app.get("/analytics/filter")
-def get_filtered_data(period: str, city: str, year: str = "All Years"):
-    conn = get_db()
-    
+def build_sales_filter(period, city, year, approx_mode=False):
+    """
+    Shared city/year/period filter for Fact_Sales (used by /analytics/filter and /export/sales).
+    Only references columns that Sample_Sales has too. Returns (where_clause, params, group_by).
+    """
     # --- 1. FIND THE SMART REFERENCE DATE ---
     # Find the latest date in the database based on the selected year
     base_date_query = "SELECT MAX(date_key) FROM Fact_Sales WHERE 1=1"
@@ -247,37 +479,45 @@ def get_filtered_data(period: str, city: str, year: str = "All Years"):
         base_date_query += " AND strftime('%Y', date_key) = ?"
         base_params.append(year)
         
-    max_date_row = conn.execute(base_date_query, base_params).fetchone()
+    if approx_mode:
+        # Every stratum tracks its latest date, so this stays exact without touching Fact_Sales
+        conn = get_db()
+        try:
+            max_dates = [d for d in [approx.max_date(conn, year)] if d]
+        finally:
+            conn.close()
+    else:
+        max_dates = [r[0] for rows in query_sales(base_date_query, base_params, year=year) for r in rows if r[0]]
     
     # If the database has data, use the max date as 'now'. Otherwise, use today.
-    if max_date_row and max_date_row[0]:
-        ref_date = max_date_row[0]
+    if max_dates:
+        ref_date = max(max_dates)
     else:
         ref_date = datetime.now().strftime("%Y-%m-%d")
 
-    # --- 2. BUILD THE MAIN QUERY ---
-    sql = "SELECT date_key, total_amount, product_key FROM Fact_Sales WHERE 1=1"
+    # --- 2. BUILD THE WHERE CLAUSE ---
+    where = "1=1"
     params = []
 
     # Apply City Filter
     if city != "All Cities":
-        sql += " AND city = ?"
+        where += " AND city = ?"
         params.append(city)
 
     # Apply Year Filter
     if year != "All Years":
-        sql += " AND strftime('%Y', date_key) = ?"
+        where += " AND strftime('%Y', date_key) = ?"
         params.append(year)
 
     # Apply Time Filter relative to the SMART reference date
     if period == "Last 30 Days":
-        sql += f" AND date_key >= date('{ref_date}', '-30 days')"
+        where += f" AND date_key >= date('{ref_date}', '-30 days')"
         group_by = "date_key" # Group by day
     elif period == "Last 6 Months":
-        sql += f" AND date_key >= date('{ref_date}', '-6 months')"
+        where += f" AND date_key >= date('{ref_date}', '-6 months')"
         group_by = "strftime('%Y-%m', date_key)" # Group by month
     elif period == "Last Year":
-        sql += f" AND date_key >= date('{ref_date}', '-1 year')"
+        where += f" AND date_key >= date('{ref_date}', '-1 year')"
         group_by = "strftime('%Y-%m', date_key)" # Group by month
     else: # "All Time"
         if year != "All Years":
@@ -285,14 +525,180 @@ def get_filtered_data(period: str, city: str, year: str = "All Years"):
         else:
             group_by = "strftime('%Y', date_key)" # Show full years
 
+    return where, params, group_by
+
+@app.get("/analytics/filter")
+def get_filtered_data(period: str, city: str, year: str = "All Years", approx_mode: bool = Query(False, alias="approx")):
+    where, params, group_by = build_sales_filter(period, city, year, approx_mode)
+
+    if approx_mode:
+        conn = get_db()
+        try:
+            if period in ("Last 30 Days", "Last 6 Months", "Last Year"):
+                revenue = approx.estimate_groups(conn, group_by, where, params)
+            else:
+                # All Time groups whole strata (years, or the months of one year)
+                revenue = approx.estimate_strata(conn, "year" if year == "All Years" else "month", city, year)
+            prods = approx.estimate_groups(conn, "product_key", where, params)
+            top = sorted(prods.items(), key=lambda kv: kv[1]["count"], reverse=True)[:5]
+            return {
+                "revenue_chart": [{"name": label or 'Unknown', "revenue": revenue[label]["amount"],
+                                   "error": approx.bound(revenue[label]["amount_var"])} for label in sort_labels(revenue)],
+                "top_products": [{"name": p, "sales": round(g["count"]), "error": approx.bound(g["count_var"])} for p, g in top],
+                "approx": True
+            }
+        finally:
+            conn.close()
+
+    sql = f"SELECT date_key, total_amount, product_key FROM Fact_Sales WHERE {where}"
+
     # --- 3. EXECUTE QUERIES ---
-    rev_sql = f"SELECT {group_by} as label, SUM(total_amount) as val FROM ({sql}) GROUP BY label ORDER BY label"
-    revenue_rows = conn.execute(rev_sql, params).fetchall()
+    rev_sql = f"SELECT {group_by} as label, SUM(total_amount) as val FROM ({sql}) GROUP BY label"
+    revenue = merge_partials(query_sales(rev_sql, params, city=city, year=year))
 
-    prod_sql = f"SELECT product_key, COUNT(*) as val FROM ({sql}) GROUP BY product_key ORDER BY val DESC LIMIT 5"
-    prod_rows = conn.execute(prod_sql, params).fetchall()
+    prod_sql = f"SELECT product_key, COUNT(*) as val FROM ({sql}) GROUP BY product_key"
+    prods = merge_partials(query_sales(prod_sql, params, city=city, year=year))
 
     return {
-        "revenue_chart": [{"name": r['label'] or 'Unknown', "revenue": r['val']} for r in revenue_rows],
-        "top_products": [{"name": r['product_key'], "sales": r['val']} for r in prod_rows]
-    }
\ No newline at end of file
+        "revenue_chart": [{"name": label or 'Unknown', "revenue": revenue[label][0]} for label in sort_labels(revenue)],
+        "top_products": [{"name": p, "sales": v[0]} for p, v in top_k(prods, 5)]
+    }
+
+# --- 5. BULK EXPORT ---
+EXPORT_COLUMNS = ['transaction_id', 'date_key', 'product_key', 'quantity', 'total_amount',
+                  'city', 'customer_name', 'season', 'source_system']
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+class StreamSink:
+    """Write-only file object for pyarrow writers; buffered bytes are drained after every batch."""
+    def __init__(self):
+        self.buf = io.BytesIO()
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buf.write(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self.buf.getvalue()
+        self.buf.seek(0)
+        self.buf.truncate()
+        return data
+
+def iter_sales_batches(paths, where, params, after_shard, after, limit, batch_size):
+    """
+    Keyset pagination on (shard, rowid): every batch is an index seek, never an OFFSET scan.
+    Shards are read one after another in name order; the cursor is the last (shard, row_id) seen.
+    Without `after_shard`, `after` applies to the first shard ("main" when unsharded).
+    """
+    cols = ", ".join(EXPORT_COLUMNS)
+    remaining = limit
+    names = [sharding.shard_name(p) if sharding.is_sharded() else "main" for p in paths]
+    if not after_shard and names:
+        after_shard = names[0]
+    for path, name in zip(paths, names):
+        if name < after_shard:
+            continue
+        last_id = after if name == after_shard else 0
+
+        # The generator is resumed on Starlette's threadpool, so the connection hops threads
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None else min(batch_size, remaining)
+                rows = conn.execute(
+                    f"SELECT ?, rowid, {cols} FROM Fact_Sales WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?",
+                    [name, last_id] + params + [size]
+                ).fetchall()
+                if not rows:
+                    break
+                yield rows
+                last_id = rows[-1][1]
+                if remaining is not None:
+                    remaining -= len(rows)
+                if len(rows) < size:
+                    break
+        finally:
+            conn.close()
+
+def stream_csv(batches):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['shard', 'row_id'] + EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(tuple(r) for r in rows)
+        yield out.getvalue().encode()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
+
+def stream_arrow(batches, fmt):
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ('shard', pa.string()), ('row_id', pa.int64()), ('transaction_id', pa.string()), ('date_key', pa.string()),
+        ('product_key', pa.string()), ('quantity', pa.int64()), ('total_amount', pa.float64()),
+        ('city', pa.string()), ('customer_name', pa.string()), ('season', pa.string()),
+        ('source_system', pa.string()),
+    ])
+    sink = StreamSink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+
+    for rows in batches:
+        columns = list(zip(*rows))
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema
+        )
+        # One row group (Parquet) / record batch (Arrow) per fetched batch
+        write(pa.Table.from_batches([batch]) if fmt == "parquet" else batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+@app.get("/export/sales", dependencies=[Depends(verify_key)])
+def export_sales(format: str = "csv", period: str = "All Time", city: str = "All Cities",
+                 year: str = "All Years", after_shard: str = None, after: int = 0, limit: int = None,
+                 batch_size: int = 50000):
+    """
+    Streams Fact_Sales rows matching the /analytics/filter filters as CSV, Arrow IPC or Parquet.
+    Rows come out in (shard, row_id) order; pass the last shard / row_id seen as
+    `after_shard` / `after` to resume an export.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{format}'. Use one of: {', '.join(EXPORT_FORMATS)}")
+    if batch_size < 1 or batch_size > 500000:
+        raise HTTPException(status_code=400, detail="batch_size must be between 1 and 500000")
+    if format != "csv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="pyarrow is required for Arrow/Parquet export")
+
+    where, params, _ = build_sales_filter(period, city, year)
+    batches = iter_sales_batches(sales_dbs(city, year), where, params, after_shard, after, limit, batch_size)
+    body = stream_csv(batches) if format == "csv" else stream_arrow(batches, format)
+    media_type, ext = EXPORT_FORMATS[format]
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="fact_sales.{ext}"'})
@@ -0,0 +1,431 @@
+import math
+import json
+import random
+import uuid
+import hashlib
+import threading
+from array import array
+
+# --- CONFIGURATION ---
+SAMPLE_PER_STRATUM = 500   # Reservoir size per (city, month) stratum
+CMS_WIDTH = 2719           # eps = e / width ~= 0.001 -> overcount <= 0.1% of all sales
+CMS_DEPTH = 5              # delta = e^-depth ~= 0.7% chance of exceeding that bound
+CMS_CANDIDATES = 64        # Heavy-hitter candidates kept next to the Count-Min sketch
+HLL_P = 14                 # 2^14 registers -> ~0.8% standard error
+Z_95 = 1.96
+
+_sample_lock = threading.Lock()
+
+def _hash64(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+class CountMinSketch:
+    """Count-Min sketch plus a small candidate set, so top-K can be answered without a scan."""
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = array('q', [0]) * (width * depth)
+        self.total = 0
+        self.candidates = {}
+
+    def _cells(self, key):
+        h = _hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, h >> 32
+        return [d * self.width + (h1 + d * h2) % self.width for d in range(self.depth)]
+
+    def add(self, key, count=1):
+        cells = self._cells(key)
+        for c in cells:
+            self.table[c] += count
+        self.total += count
+        est = min(self.table[c] for c in cells)
+
+        # Keep the CMS_CANDIDATES keys with the highest estimates
+        self.candidates[key] = est
+        if len(self.candidates) > CMS_CANDIDATES:
+            del self.candidates[min(self.candidates, key=self.candidates.get)]
+
+    def estimate(self, key):
+        return min(self.table[c] for c in self._cells(key))
+
+    def error_bound(self):
+        """One-sided: estimates overcount by at most this much with probability 1 - e^-depth."""
+        return math.e / self.width * self.total
+
+    def top_k(self, k):
+        ests = {key: self.estimate(key) for key in self.candidates}
+        return sorted(ests.items(), key=lambda kv: kv[1], reverse=True)[:k]
+
+    def to_bytes(self):
+        return self.table.tobytes()
+
+    def meta(self):
+        return {"width": self.width, "depth": self.depth, "total": self.total, "candidates": self.candidates}
+
+    @classmethod
+    def load(cls, data, meta):
+        cms = cls(meta["width"], meta["depth"])
+        cms.table = array('q')
+        cms.table.frombytes(data)
+        cms.total = meta["total"]
+        cms.candidates = meta["candidates"]
+        return cms
+
+class HyperLogLog:
+    """HyperLogLog distinct counter (standard estimator with small-range correction)."""
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, key):
+        h = _hash64(key)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        est = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if est <= 2.5 * self.m and zeros:
+            est = self.m * math.log(self.m / zeros)
+        return est
+
+    def error_bound(self):
+        """95% interval half-width."""
+        return Z_95 * 1.04 / math.sqrt(self.m) * self.estimate()
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def meta(self):
+        return {"p": self.p}
+
+    @classmethod
+    def load(cls, data, meta):
+        hll = cls(meta["p"])
+        hll.registers = bytearray(data)
+        return hll
+
+# --- STORAGE ---
+def init_approx_tables(conn, fresh=False):
+    cursor = conn.cursor()
+    if fresh:
+        for t in ['Sample_Sales', 'Sample_Strata', 'Sketch_State', 'Sketch_Pending']:
+            cursor.execute(f'DROP TABLE IF EXISTS {t}')
+
+    # Stratified reservoir sample of Fact_Sales, one reservoir per (city, month)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Sample_Strata (
+            stratum TEXT PRIMARY KEY,
+            city TEXT,
+            month TEXT,
+            seen INTEGER,
+            sampled INTEGER,
+            max_date DATE,
+            sample_sum REAL,
+            sample_sumsq REAL
+        )
+    ''')
+    # sample_sum / sample_sumsq: SUM and SUM of squares of total_amount over the stratum's
+    # sampled rows, so whole-stratum estimates (month / year totals) never touch Sample_Sales
+    strata_cols = [r[1] for r in cursor.execute('PRAGMA table_info(Sample_Strata)')]
+    if 'sample_sum' not in strata_cols:
+        print("   Upgrading Sample_Strata with per-stratum sample sums...")
+        cursor.execute('ALTER TABLE Sample_Strata ADD COLUMN sample_sum REAL')
+        cursor.execute('ALTER TABLE Sample_Strata ADD COLUMN sample_sumsq REAL')
+        cursor.execute('''
+            UPDATE Sample_Strata SET
+                sample_sum = (SELECT COALESCE(SUM(total_amount), 0) FROM Sample_Sales s
+                              WHERE s.stratum = Sample_Strata.stratum),
+                sample_sumsq = (SELECT COALESCE(SUM(total_amount * total_amount), 0) FROM Sample_Sales s
+                                WHERE s.stratum = Sample_Strata.stratum)
+        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Sample_Sales (
+            stratum TEXT,
+            slot INTEGER,
+            date_key DATE,
+            product_key TEXT,
+            total_amount REAL,
+            city TEXT,
+            customer_name TEXT,
+            PRIMARY KEY (stratum, slot)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sample_city_date ON Sample_Sales (city, date_key)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Sketch_State (
+            name TEXT PRIMARY KEY,
+            data BLOB,
+            meta TEXT
+        )
+    ''')
+    # Ingested sales not yet folded into Sketch_State; written in the same transaction as
+    # the sample update, so no process or crash can lose them
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Sketch_Pending (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_key TEXT,
+            customer_name TEXT
+        )
+    ''')
+    conn.commit()
+
+def save_sketches(conn, products, customers, build_id, version=0):
+    """
+    `build_id` identifies the ETL run the sketches descend from, `version` counts the
+    folds of Sketch_Pending into it since (see SketchStore). The caller commits.
+    """
+    conn.executemany("INSERT OR REPLACE INTO Sketch_State VALUES (?, ?, ?)", [
+        ('product_cms', products.to_bytes(), json.dumps(products.meta())),
+        ('customer_hll', customers.to_bytes(), json.dumps(customers.meta())),
+        ('build', None, json.dumps({"id": build_id, "version": version})),
+    ])
+
+def current_version(conn):
+    """(build_id, version) of the stored sketches."""
+    row = conn.execute("SELECT meta FROM Sketch_State WHERE name = 'build'").fetchone()
+    meta = json.loads(row[0]) if row else {}
+    return meta.get("id"), meta.get("version", 0)
+
+def load_sketches(conn):
+    state = {r[0]: (r[1], json.loads(r[2])) for r in conn.execute("SELECT name, data, meta FROM Sketch_State")}
+    products = CountMinSketch.load(*state['product_cms']) if 'product_cms' in state else CountMinSketch()
+    customers = HyperLogLog.load(*state['customer_hll']) if 'customer_hll' in state else HyperLogLog()
+    return products, customers
+
+def fold_pending(conn, products, customers, after_id=0):
+    """Adds the Sketch_Pending rows with id > after_id to the sketches; returns the last id folded."""
+    last = after_id
+    for row_id, product_key, customer_name in conn.execute(
+            "SELECT id, product_key, customer_name FROM Sketch_Pending WHERE id > ? ORDER BY id", (after_id,)):
+        products.add(product_key)
+        if customer_name:
+            customers.add(customer_name)
+        last = row_id
+    return last
+
+def build_from_sales(conn, df_sales, per_stratum=SAMPLE_PER_STRATUM):
+    """ETL: builds the stratified sample and the sketches from the full cleaned sales frame."""
+    df = df_sales[['date_key', 'product_key', 'total_amount', 'city', 'customer_name']].copy()
+    df['month'] = df['date_key'].str[:7]
+    df['stratum'] = df['city'].fillna('Unknown') + '|' + df['month'].fillna('Unknown')
+
+    # Shuffle once, then the first `per_stratum` rows of every stratum are a uniform sample
+    df = df.sample(frac=1)
+    df['slot'] = df.groupby('stratum').cumcount()
+    sample = df[df['slot'] < per_stratum]
+    sample[['stratum', 'slot', 'date_key', 'product_key', 'total_amount', 'city', 'customer_name']].to_sql(
+        'Sample_Sales', conn, if_exists='append', index=False)
+
+    strata = df.groupby('stratum').agg(
+        city=('city', 'first'), month=('month', 'first'), seen=('slot', 'size'), max_date=('date_key', 'max'))
+    strata['sampled'] = strata['seen'].clip(upper=per_stratum)
+    amount = sample['total_amount'].fillna(0)
+    strata['sample_sum'] = amount.groupby(sample['stratum']).sum()
+    strata['sample_sumsq'] = (amount * amount).groupby(sample['stratum']).sum()
+    strata.reset_index()[['stratum', 'city', 'month', 'seen', 'sampled', 'max_date', 'sample_sum', 'sample_sumsq']].to_sql(
+        'Sample_Strata', conn, if_exists='append', index=False)
+
+    products = CountMinSketch()
+    for key, count in df['product_key'].value_counts().items():
+        products.add(key, int(count))
+    customers = HyperLogLog()
+    for name in df['customer_name'].dropna().unique():
+        customers.add(name)
+    save_sketches(conn, products, customers, uuid.uuid4().hex)
+    conn.commit()
+    print(f"   Approx: sampled {len(sample)} rows across {len(strata)} strata; sketches saved.")
+
+def _copy(sketch):
+    return type(sketch).load(sketch.to_bytes(), json.loads(json.dumps(sketch.meta())))
+
+class SketchStore:
+    """
+    Read-side cache of the sketches for the API. Ingest only appends to Sketch_Pending;
+    every `flush_every` rows one process folds the log into Sketch_State under a write lock
+    (read-merge-write), so concurrent workers never overwrite each other's updates.
+    Reads see Sketch_State plus whatever is still pending.
+    """
+    def __init__(self, flush_every=100):
+        self.lock = threading.Lock()
+        self.products = None
+        self.customers = None
+        self.version = None
+        self.folded_id = 0
+        self.flush_every = flush_every
+
+    def snapshot(self, conn):
+        """Current (products, customers) sketches. Returned objects are never mutated afterwards."""
+        with self.lock:
+            # One read transaction, so a concurrent flush can't be seen half-applied
+            conn.execute("BEGIN")
+            try:
+                version = current_version(conn)
+                if self.products is None or version != self.version:
+                    self.products, self.customers = load_sketches(conn)
+                    self.version = version
+                    self.folded_id = 0
+                last = conn.execute("SELECT MAX(id) FROM Sketch_Pending").fetchone()[0] or 0
+                if last > self.folded_id:
+                    # Fold into copies: earlier snapshots may still be read by other requests
+                    self.products, self.customers = _copy(self.products), _copy(self.customers)
+                    self.folded_id = fold_pending(conn, self.products, self.customers, self.folded_id)
+            finally:
+                conn.rollback()
+            return self.products, self.customers
+
+    def observe(self, conn, pending_id):
+        """Called after observe_sale() logged row `pending_id`; folds the log every flush_every rows."""
+        if pending_id % self.flush_every == 0:
+            self.flush(conn)
+
+    def flush(self, conn):
+        with self.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                build_id, version = current_version(conn)
+                products, customers = load_sketches(conn)
+                last = fold_pending(conn, products, customers)
+                if last:
+                    save_sketches(conn, products, customers, build_id, version + 1)
+                    conn.execute("DELETE FROM Sketch_Pending WHERE id <= ?", (last,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        # The cache reloads on the next read, when it sees the new version
+
+def observe_sale(conn, date_key, product_key, total_amount, city, customer_name, per_stratum=SAMPLE_PER_STRATUM):
+    """
+    Ingest: reservoir-sampling update (Algorithm R) of the row's (city, month) stratum, and
+    the row appended to Sketch_Pending. Returns the Sketch_Pending id.
+    """
+    month = date_key[:7]
+    stratum = f"{city}|{month}"
+    # Read-modify-write of the stratum counters: serialize it across threads (lock) and
+    # across processes (write lock taken before the SELECT)
+    with _sample_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _reservoir_update(conn, stratum, month, date_key, product_key, total_amount, city, customer_name, per_stratum)
+            pending_id = conn.execute("INSERT INTO Sketch_Pending (product_key, customer_name) VALUES (?, ?)",
+                                      (product_key, customer_name)).lastrowid
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return pending_id
+
+def _reservoir_update(conn, stratum, month, date_key, product_key, total_amount, city, customer_name, per_stratum):
+    amount = total_amount or 0.0
+    row = conn.execute("SELECT seen, sampled, max_date, sample_sum, sample_sumsq FROM Sample_Strata WHERE stratum = ?",
+                       (stratum,)).fetchone()
+    if row is None:
+        seen, sampled, max_date, sy, syy = 1, 1, date_key, 0.0, 0.0
+        slot = 0
+    else:
+        seen, sampled, max_date = row[0] + 1, row[1], max(row[2] or date_key, date_key)
+        sy, syy = row[3] or 0.0, row[4] or 0.0
+        if sampled < per_stratum:
+            slot = sampled
+            sampled += 1
+        else:
+            j = random.randrange(seen)
+            slot = j if j < per_stratum else None
+            if slot is not None:
+                # The replaced row leaves the sample sums
+                old = conn.execute("SELECT total_amount FROM Sample_Sales WHERE stratum = ? AND slot = ?",
+                                   (stratum, slot)).fetchone()
+                old_amount = (old[0] or 0.0) if old else 0.0
+                sy -= old_amount
+                syy -= old_amount * old_amount
+
+    if slot is not None:
+        sy += amount
+        syy += amount * amount
+        conn.execute("INSERT OR REPLACE INTO Sample_Sales VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (stratum, slot, date_key, product_key, total_amount, city, customer_name))
+    conn.execute("""
+        INSERT OR REPLACE INTO Sample_Strata (stratum, city, month, seen, sampled, max_date, sample_sum, sample_sumsq)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (stratum, city, month, seen, sampled, max_date, sy, syy))
+
+# --- ESTIMATORS ---
+def max_date(conn, year=None):
+    sql = "SELECT MAX(max_date) FROM Sample_Strata"
+    params = []
+    if year and year != "All Years":
+        sql += " WHERE month LIKE ?"
+        params.append(f"{year}-%")
+    return conn.execute(sql, params).fetchone()[0]
+
+def _add_stratum(out, label, big_n, n, cx, sy, syy):
+    """Adds one stratum's contribution for `label` (cx of its n sampled rows, summing to sy / syy)."""
+    g = out.setdefault(label, {"amount": 0.0, "amount_var": 0.0, "count": 0.0, "count_var": 0.0, "cov": 0.0})
+    g["amount"] += big_n / n * sy
+    g["count"] += big_n / n * cx
+    if n > 1 and big_n > n:
+        # Domain estimator: rows outside the label count as zeros in this stratum's sample
+        factor = big_n * big_n * (1 - n / big_n) / n
+        g["amount_var"] += factor * (syy - sy * sy / n) / (n - 1)
+        g["count_var"] += factor * (cx - cx * cx / n) / (n - 1)
+        g["cov"] += factor * (sy - sy * cx / n) / (n - 1)
+
+def estimate_groups(conn, label_sql, where="1=1", params=()):
+    """
+    Stratified estimates of SUM(total_amount) and COUNT(*) per label over the rows matching
+    `where`. Returns {label: {"amount", "amount_var", "count", "count_var", "cov"}}.
+    """
+    strata = {r[0]: (r[1], r[2]) for r in conn.execute("SELECT stratum, seen, sampled FROM Sample_Strata")}
+    rows = conn.execute(f"""
+        SELECT stratum, {label_sql} AS label, COUNT(*), SUM(total_amount), SUM(total_amount * total_amount)
+        FROM Sample_Sales WHERE {where}
+        GROUP BY stratum, label
+    """, params).fetchall()
+
+    out = {}
+    for stratum, label, cx, sy, syy in rows:
+        big_n, n = strata.get(stratum, (0, 0))
+        if n:
+            _add_stratum(out, label, big_n, n, cx, sy or 0.0, syy or 0.0)
+    return out
+
+def estimate_strata(conn, by="month", city=None, year=None):
+    """
+    Same as estimate_groups() for labels that are whole strata - month ('2024-03') or year
+    ('2024') - read from the per-stratum sample sums alone, so the cost is O(strata).
+    Rows without a date have a NULL month (and label).
+    """
+    label_sql = "month" if by == "month" else "substr(month, 1, 4)"
+    where, params = "1=1", []
+    if city and city != "All Cities":
+        where += " AND city = ?"
+        params.append(city)
+    if year and year != "All Years":
+        where += " AND month LIKE ?"
+        params.append(f"{year}-%")
+
+    out = {}
+    for label, big_n, n, sy, syy in conn.execute(f"""
+        SELECT {label_sql}, seen, sampled, sample_sum, sample_sumsq FROM Sample_Strata WHERE {where}
+    """, params):
+        if n:
+            _add_stratum(out, label, big_n, n, n, sy or 0.0, syy or 0.0)
+    return out
+
+def bound(var):
+    """95% interval half-width from a variance."""
+    return Z_95 * math.sqrt(max(var, 0.0))
+
+def ratio_bound(g):
+    """95% half-width of amount / count (delta method)."""
+    if not g["count"]:
+        return None
+    r = g["amount"] / g["count"]
+    var = (g["amount_var"] + r * r * g["count_var"] - 2 * r * g["cov"]) / (g["count"] ** 2)
+    return bound(var)
@@ -4,8 +4,12 @@ import os
 import ast
 import json
 import random
+import hashlib
 from datetime import datetime
 
+import sharding
+import approx
+
 # --- CONFIGURATION ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, '..', 'data', 'raw')
@@ -20,10 +24,17 @@ def init_star_schema(conn):
     cursor = conn.cursor()
     
     # Drop existing tables to start fresh
-    tables = ['Fact_Sales', 'Fact_Inventory', 'Fact_Shipments', 'Dim_Product', 'Dim_Customer', 'Dim_Store']
+    # (Dim_Customer is kept: it carries the SCD Type 2 history across runs)
+    tables = ['Fact_Sales', 'Fact_Inventory', 'Fact_Shipments', 'Dim_Product', 'Dim_Store', 'Sales_Keys']
     for t in tables:
         cursor.execute(f'DROP TABLE IF EXISTS {t}')
 
+    # Older databases have a Dim_Customer without the hash column - rebuild those
+    cust_cols = [r[1] for r in cursor.execute("PRAGMA table_info(Dim_Customer)").fetchall()]
+    if cust_cols and 'attr_hash' not in cust_cols:
+        print("   Upgrading legacy Dim_Customer to hashed SCD Type 2 layout...")
+        cursor.execute('DROP TABLE Dim_Customer')
+
     # 1. DIMENSION: Products
     cursor.execute('''
         CREATE TABLE Dim_Product (
@@ -33,17 +44,23 @@ def init_star_schema(conn):
         )
     ''')
 
-    # 2. DIMENSION: Customers (SCD Type 2 Ready)
+    # 2. DIMENSION: Customers (SCD Type 2)
+    # attr_hash fingerprints the tracked attributes (city, category)
     cursor.execute('''
-        CREATE TABLE Dim_Customer (
+        CREATE TABLE IF NOT EXISTS Dim_Customer (
             customer_key TEXT,
             name TEXT,
             city TEXT,
+            category TEXT,
+            attr_hash INTEGER,
             valid_from DATE,
             valid_to DATE,
             is_current INTEGER
         )
     ''')
+    # One current row per customer; this index drives the change-detection join
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_customer_current ON Dim_Customer (name) WHERE is_current = 1')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_customer_key ON Dim_Customer (customer_key)')
 
     # 3. DIMENSION: Stores
     cursor.execute('''
@@ -87,7 +104,91 @@ def init_star_schema(conn):
         )
     ''')
     
+    # 7. GLOBAL SALES KEY REGISTRY (only filled in sharded mode)
+    cursor.execute(sharding.SALES_KEYS_DDL)
+
+    # 8. APPROXIMATE-QUERY SAMPLE & SKETCHES (rebuilt with the facts)
+    approx.init_approx_tables(conn, fresh=True)
+
+    conn.commit()
+
+def attr_hash(city, category):
+    """Stable 64-bit fingerprint of the tracked customer attributes (signed, to fit SQLite INTEGER)."""
+    text = f"{'' if pd.isna(city) else city}\x1f{'' if pd.isna(category) else category}"
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big', signed=True)
+
+def merge_customer_scd2(conn, df_customers, as_of):
+    """
+    SCD Type 2 merge of a customer snapshot (name, city, category, first_seen) into Dim_Customer.
+    Changes are detected by comparing attribute hashes against the current rows, then
+    closed out / inserted set-wise in SQL so the merge scales to millions of customers.
+    """
+    cursor = conn.cursor()
+
+    df_customers = df_customers.copy()
+    df_customers['attr_hash'] = [
+        attr_hash(city, category) for city, category in zip(df_customers['city'], df_customers['category'])
+    ]
+
+    # Stage the snapshot in a temp table keyed by name
+    cursor.execute('DROP TABLE IF EXISTS temp.Stg_Customer')
+    cursor.execute('''
+        CREATE TEMP TABLE Stg_Customer (
+            name TEXT PRIMARY KEY,
+            city TEXT,
+            category TEXT,
+            attr_hash INTEGER,
+            first_seen DATE
+        )
+    ''')
+    cursor.executemany(
+        "INSERT OR REPLACE INTO Stg_Customer VALUES (?, ?, ?, ?, ?)",
+        df_customers[['name', 'city', 'category', 'attr_hash', 'first_seen']].itertuples(index=False, name=None)
+    )
+
+    # Delta = brand-new customers + customers whose hash no longer matches the current row
+    # (attributes are compared too, so rows hashed by an older scheme aren't re-versioned)
+    cursor.execute('DROP TABLE IF EXISTS temp.Stg_Customer_Delta')
+    cursor.execute('''
+        CREATE TEMP TABLE Stg_Customer_Delta AS
+        SELECT s.name, s.city, s.category, s.attr_hash, s.first_seen, d.customer_key
+        FROM Stg_Customer s
+        LEFT JOIN Dim_Customer d ON d.name = s.name AND d.is_current = 1
+        WHERE d.customer_key IS NULL
+        OR (d.attr_hash <> s.attr_hash AND (d.city IS NOT s.city OR d.category IS NOT s.category))
+    ''')
+
+    # 1. Close out the current versions of changed customers
+    closed = cursor.execute('''
+        UPDATE Dim_Customer SET valid_to = ?, is_current = 0
+        WHERE is_current = 1
+        AND name IN (SELECT name FROM Stg_Customer_Delta WHERE customer_key IS NOT NULL)
+    ''', (as_of,)).rowcount
+
+    # 2. Insert new versions; new customers get the next surrogate keys
+    max_key = cursor.execute("SELECT MAX(customer_key) FROM Dim_Customer").fetchone()[0]
+    next_key = int(max_key[1:]) + 1 if max_key else 0
+    inserted = cursor.execute('''
+        INSERT INTO Dim_Customer (customer_key, name, city, category, attr_hash, valid_from, valid_to, is_current)
+        SELECT
+            COALESCE(customer_key, printf('C%08d', ? + ROW_NUMBER() OVER (PARTITION BY customer_key IS NULL ORDER BY name) - 1)),
+            name, city, category, attr_hash,
+            CASE WHEN customer_key IS NULL THEN first_seen ELSE ? END,
+            '9999-12-31', 1
+        FROM Stg_Customer_Delta
+    ''', (next_key, as_of)).rowcount
+
+    # 3. Refresh stale hashes on unchanged current rows
+    cursor.execute('''
+        UPDATE Dim_Customer SET attr_hash = s.attr_hash
+        FROM Stg_Customer s
+        WHERE Dim_Customer.name = s.name AND Dim_Customer.is_current = 1 AND Dim_Customer.attr_hash <> s.attr_hash
+    ''')
+
+    cursor.execute('DROP TABLE temp.Stg_Customer_Delta')
+    cursor.execute('DROP TABLE temp.Stg_Customer')
     conn.commit()
+    print(f"   SCD2 Merge: {inserted - closed} new customers, {closed} changed (closed & re-versioned).")
 
 def run_pipeline():
     conn = sqlite3.connect(DB_PATH)
@@ -172,7 +273,6 @@ def run_pipeline():
     
     sales_data = []
     unique_products = set()
-    unique_customers = {} # Map name -> city for Dimension
 
     for _, row in df.iterrows():
         items = row['Product_List']
@@ -194,10 +294,6 @@ def run_pipeline():
                 'season': row['Season'],
                 'source_system': row.get('source_system', 'Unknown')
             })
-            
-            # Capture customer info for dimension logic
-            if row['Customer_Name'] not in unique_customers:
-                unique_customers[row['Customer_Name']] = row['City']
     
     df_sales = pd.DataFrame(sales_data)
 
@@ -213,19 +309,18 @@ def run_pipeline():
     # Product Dim
     df_products = pd.DataFrame({'product_key': list(unique_products), 'name': list(unique_products), 'category': 'General'})
     
-    # Customer Dim (SCD Type 2 Prep)
-    print("   Building Customer Dimension (SCD Type 2)...")
-    cust_list = []
-    for i, (name, city) in enumerate(unique_customers.items()):
-        cust_list.append({
-            'customer_key': f'C{i:05d}', 
-            'name': name, 
-            'city': city,
-            'valid_from': '2020-01-01', 
-            'valid_to': '9999-12-31', 
-            'is_current': 1
-        })
-    df_customers = pd.DataFrame(cust_list)
+    # Customer Dim snapshot: latest city/category per customer, plus first purchase date
+    # (same-day rows are tie-broken on city/category so the winner doesn't depend on file order)
+    print("   Building Customer Snapshot (SCD Type 2)...")
+    df_cust_src = pd.DataFrame({
+        'name': df['Customer_Name'],
+        'city': df['City'],
+        'category': df['Customer_Category'] if 'Customer_Category' in df else None,
+        'date': pd.to_datetime(df['Date'])
+    }).dropna(subset=['name']).sort_values(['date', 'city', 'category'], kind='stable')
+    df_customers = df_cust_src.drop_duplicates(subset=['name'], keep='last').drop(columns=['date'])
+    first_seen = df_cust_src.groupby('name')['date'].min().dt.strftime("%Y-%m-%d")
+    df_customers['first_seen'] = df_customers['name'].map(first_seen)
 
     # Store Dim (Simple derived from cities)
     unique_cities = df_sales['city'].unique()
@@ -249,9 +344,18 @@ def run_pipeline():
     
     # Save to SQLite
     df_products.to_sql('Dim_Product', conn, if_exists='append', index=False)
-    df_customers.to_sql('Dim_Customer', conn, if_exists='append', index=False)
+    merge_customer_scd2(conn, df_customers, datetime.now().strftime("%Y-%m-%d"))
     df_stores.to_sql('Dim_Store', conn, if_exists='append', index=False)
-    df_sales.to_sql('Fact_Sales', conn, if_exists='append', index=False)
+    if sharding.is_sharded():
+        # Facts live in per-year / per-city shard files; the main Fact_Sales stays empty
+        print(f"   Writing Fact_Sales shards (by {sharding.SHARD_MODE})...")
+        sharding.write_shards(df_sales)
+        df_sales[['transaction_id', 'product_key']].to_sql('Sales_Keys', conn, if_exists='append', index=False)
+    else:
+        df_sales.to_sql('Fact_Sales', conn, if_exists='append', index=False)
+    # Uniqueness key for idempotent real-time ingest (built after the bulk load, which is faster)
+    conn.execute(sharding.FACT_SALES_INDEX)
+    approx.build_from_sales(conn, df_sales)
     df_inventory.to_sql('Fact_Inventory', conn, if_exists='append', index=False)
     df_shipments.to_sql('Fact_Shipments', conn, if_exists='append', index=False)
 
@@ -2,6 +2,7 @@ import requests
 import time
 import random
 import json
+import uuid
 
 # --- CONFIGURATION ---
 API_URL = "http://127.0.0.1:8000/ingest/order"
@@ -19,7 +20,7 @@ SEASONS = ['Winter', 'Spring', 'Summer', 'Fall']
 
 def generate_live_order():
     return {
-        "transaction_id": str(random.randint(100000, 999999)),
+        "transaction_id": f"POS-{uuid.uuid4().hex[:12]}",
         "source": "RealTime-POS",
         "product_id": random.choice(PRODUCTS),
         "quantity": random.randint(1, 5),
@@ -42,7 +43,9 @@ def run_producer():
         order = generate_live_order()
         try:
             response = requests.post(API_URL, json=order, headers=headers)
-            if response.status_code == 200:
+            if response.status_code == 200 and response.json().get('status') == 'duplicate':
+                print(f"♻️ Duplicate Order Ignored: {order['transaction_id']} | {order['product_id']}")
+            elif response.status_code == 200:
                 print(f"✅ Sent Order: {order['product_id']} | {order['season']} | ${order['total_amount']}")
             else:
                 print(f"⚠️ Error {response.status_code}: {response.text}")
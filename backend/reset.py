@@ -17,6 +17,12 @@ def wipe_files():
     else:
         print(f"   ✓  Database already clean.")
 
+    # 1b. DELETE FACT_SALES SHARDS (sharded storage mode)
+    shard_dir = os.path.join(DATA_DIR, 'shards')
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+        print(f"   🗑️  Deleted Fact_Sales Shards")
+
     # 2. DELETE OLD GENERATED FILES (The "Bad" 2026 Data)
     # These are the files from your OLD datagenerator
     bad_files = [
@@ -0,0 +1,127 @@
+import os
+import re
+import glob
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# --- CONFIGURATION ---
+# RETAIL_SHARD_MODE=year|city splits Fact_Sales into one SQLite file per year / per city.
+# Anything else (default) keeps the single Fact_Sales table in the main database.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARD_DIR = os.path.join(BASE_DIR, '..', 'data', 'raw', 'shards')
+SHARD_MODE = os.environ.get('RETAIL_SHARD_MODE', 'none').lower()
+SHARD_WORKERS = int(os.environ.get('RETAIL_SHARD_WORKERS', os.cpu_count() or 4))
+
+FACT_SALES_DDL = '''
+    CREATE TABLE IF NOT EXISTS Fact_Sales (
+        transaction_id TEXT,
+        date_key DATE,
+        product_key TEXT,
+        quantity INTEGER,
+        total_amount REAL,
+        city TEXT,
+        customer_name TEXT,
+        season TEXT,
+        source_system TEXT
+    )
+'''
+FACT_SALES_INDEX = 'CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_txn_product ON Fact_Sales (transaction_id, product_key)'
+
+# Shard-local unique indexes can't see each other, so sharded ingest claims the
+# (transaction_id, product_key) key in this main-DB registry in the same transaction
+# as the shard write (see attach_shard)
+SALES_KEYS_DDL = '''
+    CREATE TABLE IF NOT EXISTS Sales_Keys (
+        transaction_id TEXT,
+        product_key TEXT,
+        PRIMARY KEY (transaction_id, product_key)
+    ) WITHOUT ROWID
+'''
+
+# SQLite releases the GIL while a query runs, so shard scans really do run in parallel
+_pool = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix='shard')
+
+def is_sharded():
+    return SHARD_MODE in ('year', 'city')
+
+def shard_key(date_key, city):
+    """Shard a Fact_Sales row belongs to: its year ('2024') or its city."""
+    if SHARD_MODE == 'year':
+        return str(date_key)[:4] if date_key else 'unknown'
+    return city or 'unknown'
+
+def shard_path(key):
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', str(key)).strip('_') or 'unknown'
+    return os.path.join(SHARD_DIR, f'fact_sales_{slug}.db')
+
+def shard_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def list_shards(city=None, year=None):
+    """
+    Shard files to scan, in a stable order. A city filter (city mode) or a
+    year filter (year mode) prunes the list down to the single matching shard.
+    """
+    if SHARD_MODE == 'year' and year and year != "All Years":
+        candidates = [shard_path(year)]
+    elif SHARD_MODE == 'city' and city and city != "All Cities":
+        candidates = [shard_path(city)]
+    else:
+        candidates = glob.glob(os.path.join(SHARD_DIR, 'fact_sales_*.db'))
+    return sorted(p for p in candidates if os.path.exists(p))
+
+def connect_shard(path):
+    # Shard connections are handed to pool threads, so allow cross-thread use
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def open_shard(key):
+    """Connection to the shard for `key`, creating the file and schema on first use."""
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    conn = connect_shard(shard_path(key))
+    conn.execute(FACT_SALES_DDL)
+    conn.execute(FACT_SALES_INDEX)
+    return conn
+
+def attach_shard(conn, key, alias='shard'):
+    """
+    Attaches the shard for `key` to `conn`, so one commit covers both databases.
+    SQLite only commits attached databases atomically in rollback-journal (non-WAL) mode.
+    """
+    open_shard(key).close()
+    conn.execute("ATTACH DATABASE ? AS " + alias, (shard_path(key),))
+
+def _run_on_shard(path, sql, params):
+    conn = connect_shard(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def fanout(sql, params, paths):
+    """Runs the same query on every shard in parallel; returns one row list per shard."""
+    if len(paths) == 1:
+        return [_run_on_shard(paths[0], sql, params)]
+    futures = [_pool.submit(_run_on_shard, p, sql, params) for p in paths]
+    return [f.result() for f in futures]
+
+def write_shards(df_sales):
+    """ETL load: rebuilds every shard from scratch out of the cleaned sales frame."""
+    for old in glob.glob(os.path.join(SHARD_DIR, 'fact_sales_*.db')):
+        os.remove(old)
+
+    # Vectorized version of shard_key()
+    if SHARD_MODE == 'year':
+        keys = df_sales['date_key'].str[:4].fillna('unknown')
+    else:
+        keys = df_sales['city'].fillna('unknown')
+    for key, part in df_sales.groupby(keys):
+        conn = open_shard(key)
+        # Drop the index for the bulk load and rebuild it afterwards (faster)
+        conn.execute('DROP INDEX IF EXISTS idx_sales_txn_product')
+        part.to_sql('Fact_Sales', conn, if_exists='append', index=False)
+        conn.execute(FACT_SALES_INDEX)
+        conn.commit()
+        conn.close()
+        print(f"   Shard {shard_name(shard_path(key))}: {len(part)} rows")
@@ -0,0 +1,100 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+import approx
+import sharding
+
+CITIES = ['New York', 'Houston', 'Miami', 'Seattle', 'Atlanta', 'Boston', 'Dallas', 'Chicago', 'San Francisco', 'Los Angeles']
+PRODUCTS = [f'Product {i:02d}' for i in range(30)]
+NUM_SALES = 60000
+PER_STRATUM = 40
+
+def generate_sales(seed=7):
+    """Synthetic Fact_Sales rows for 2023-2024 with clearly ranked product popularity."""
+    rng = np.random.default_rng(seed)
+    weights = 0.6 ** np.arange(len(PRODUCTS))
+    dates = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 731, NUM_SALES), unit='D')
+    return pd.DataFrame({
+        'transaction_id': [f'T{i}' for i in range(NUM_SALES)],
+        'date_key': dates.strftime('%Y-%m-%d'),
+        'product_key': rng.choice(PRODUCTS, NUM_SALES, p=weights / weights.sum()),
+        'quantity': 1,
+        'total_amount': rng.gamma(2.0, 25.0, NUM_SALES).round(2),
+        'city': rng.choice(CITIES, NUM_SALES),
+        'customer_name': [f'Customer {i}' for i in rng.integers(0, 8000, NUM_SALES)],
+        'season': 'Winter',
+        'source_system': 'Test',
+    })
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp('approx') / 'retail.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute(sharding.FACT_SALES_DDL)
+    df_sales = generate_sales()
+    df_sales.to_sql('Fact_Sales', conn, if_exists='append', index=False)
+    approx.init_approx_tables(conn, fresh=True)
+    np.random.seed(11)  # build_from_sales shuffles with the global numpy RNG
+    approx.build_from_sales(conn, df_sales, per_stratum=PER_STRATUM)
+    conn.close()
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(api, 'DB_PATH', db_path)
+        mp.setattr(api, 'sketch_store', approx.SketchStore())
+        mp.setattr(sharding, 'SHARD_MODE', 'none')
+        yield TestClient(api.app)
+
+def get_both(client, url, **params):
+    exact = client.get(url, params=params).json()
+    estimate = client.get(url, params=dict(params, approx='true')).json()
+    assert estimate['approx'] is True
+    return exact, estimate
+
+def assert_within_error(estimates, exact, key, value, slack=0):
+    """
+    Sample-based errors are 95% intervals, so a few misses are expected across many groups:
+    allow up to 15% (at least two) outside `error`, but none outside twice `error`.
+    """
+    truth = {r[key]: r[value] for r in exact}
+    assert {r[key] for r in estimates} == set(truth)
+    misses = [r for r in estimates if abs(r[value] - truth[r[key]]) > r['error'] + slack]
+    assert len(misses) <= max(2, len(estimates) * 15 // 100), misses
+    for r in estimates:
+        assert abs(r[value] - truth[r[key]]) <= 2 * r['error'] + slack, r
+
+def test_commercial_estimates(client):
+    exact, est = get_both(client, '/analytics/commercial')
+    assert_within_error(est['monthly_revenue'], exact['monthly_revenue'], 'month', 'revenue')
+
+    # Count-Min only overcounts, and by at most `error`
+    assert [p['name'] for p in est['top_products']] == [p['name'] for p in exact['top_products']]
+    for e, x in zip(est['top_products'], exact['top_products']):
+        assert x['sold'] <= e['sold'] <= x['sold'] + e['error']
+
+def test_customer_estimates(client):
+    exact, est = get_both(client, '/analytics/customer')
+    assert set(exact) <= set(est)
+    assert_within_error(est['clv_trend'], exact['clv_trend'], 'month', 'value')
+
+    conn = sqlite3.connect(api.DB_PATH)
+    distinct = conn.execute("SELECT COUNT(DISTINCT customer_name) FROM Fact_Sales").fetchone()[0]
+    conn.close()
+    assert abs(est['distinct_customers']['value'] - distinct) <= est['distinct_customers']['error']
+
+@pytest.mark.parametrize('params', [
+    {'period': 'All Time', 'city': 'All Cities'},
+    {'period': 'All Time', 'city': 'All Cities', 'year': '2024'},
+    {'period': 'All Time', 'city': 'Boston', 'year': '2024'},
+])
+def test_filter_estimates(client, params):
+    exact, est = get_both(client, '/analytics/filter', **params)
+    assert_within_error(est['revenue_chart'], exact['revenue_chart'], 'name', 'revenue')
+
+    assert [p['name'] for p in est['top_products']] == [p['name'] for p in exact['top_products']]
+    # Estimated counts are rounded to whole sales
+    assert_within_error(est['top_products'], exact['top_products'], 'name', 'sales', slack=1)